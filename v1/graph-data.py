@@ -3,37 +3,50 @@
 import pandas
 import sys
 import os
-import json
-import aqi
+import csv
 import datetime
+import io
+import numpy as np
 import psycopg2
-import psycopg2.extras
 
 import matplotlib.patches as patches
 
-def get_data(filename):
-    lines = open(filename).readlines()
-    lines = map(lambda x: x.rstrip(), lines)
-
-    def get_fields(line):
-        l = line.split(']')
-        retval = {}
-        retval['date'] = l[0][1:]
-        retval.update(json.loads(l[1]))
-        return retval
+# EPA PM2.5 -> AQI breakpoints; each row of the table maps the
+# concentration range [BP_LO, BP_HI] linearly onto [I_LO, I_HI]
+BP_LO = np.array([0.0, 12.1, 35.5, 55.5, 150.5, 250.5, 350.5])
+BP_HI = np.array([12.0, 35.4, 55.4, 150.4, 250.4, 350.4, 500.4])
+I_LO = np.array([0, 51, 101, 151, 201, 301, 401])
+I_HI = np.array([50, 100, 150, 200, 300, 400, 500])
 
-    lines = map(get_fields, lines)
+# Vectorized equivalent of aqi.to_iaqi(POLLUTANT_PM25, ..., ALGO_EPA).
+# Concentrations above the last breakpoint are extrapolated linearly.
+def pm25_to_aqi(pm):
+    pm = np.floor(np.asarray(pm, dtype=float) * 10) / 10
+    idx = np.minimum(np.searchsorted(BP_HI, pm), len(BP_HI) - 1)
+    return np.rint(
+        I_LO[idx] + (I_HI[idx] - I_LO[idx]) * (pm - BP_LO[idx]) / (BP_HI[idx] - BP_LO[idx]))
 
-    df = pandas.DataFrame(lines)
+def get_data(filename):
+    # each line is "[date] {json}"; let the C tokenizer split it at the
+    # bracket, then parse all of the json blobs in one pass
+    raw = pandas.read_csv(
+        filename,
+        sep=']',
+        names=['date', 'blob'],
+        dtype=str,
+        quoting=csv.QUOTE_NONE,
+        engine='c',
+    )
+    df = pandas.read_json(io.StringIO('\n'.join(raw['blob'])), lines=True)
     df['date'] = pandas.to_datetime(
-        df['date'],
+        raw['date'].str[1:],
         format='%d/%m/%y - %H:%M:%S:%f',
+        cache=True,
     )
 
     df = df.set_index('date')
     df = df.dropna()
-    df['aqi'] = df['pm2.5'].apply(lambda x: float(aqi.to_iaqi(
-        aqi.POLLUTANT_PM25, x, algo=aqi.ALGO_EPA)))
+    df['aqi'] = pm25_to_aqi(df['pm2.5'].values)
     print(df)
     return df
 
@@ -48,19 +61,29 @@ def insert(df):
         (now - datetime.timedelta(seconds=8), 12, 27, 102, 1002),
         (now - datetime.timedelta(seconds=7), 13, 28, 103, 1003),
     ]
-    insert_query = 'insert into particulate (time, pm10, pm25, pm100, aqi) values %s'
-    df = df.copy()
-    df.reset_index(inplace=True)
-    psycopg2.extras.execute_values(
-        cursor,
-        insert_query,
-        df.values,
-        template=None,
+    # send only the columns the table has, in table order. The table's
+    # columns are integers, and COPY won't accept "21.0" for those, so
+    # convert the float columns (the computed AQI, and any pm column
+    # that had gaps) back to ints first.
+    df = df.reset_index()[['date', 'pm1.0', 'pm2.5', 'pm10.0', 'aqi']]
+    df = df.astype({
+        'pm1.0': 'int64',
+        'pm2.5': 'int64',
+        'pm10.0': 'int64',
+        'aqi': 'int64',
+    })
+    buf = io.StringIO()
+    df.to_csv(buf, header=False, index=False)
+    buf.seek(0)
+    cursor.copy_expert(
+        'COPY particulate (time, pm10, pm25, pm100, aqi) FROM STDIN WITH CSV',
+        buf,
     )
     conn.commit()
 
 def graph(df):
-    df = df.rolling(60).mean()
+    # only smooth the columns that get plotted
+    df = df[['pm1.0', 'pm2.5', 'pm10.0', 'aqi']].rolling(60).mean()
     plot = df[['pm1.0', 'pm2.5', 'pm10.0']].plot(grid=True, figsize=(20, 10))
     plot.set_title("Jer - Particulate Concentrations\n60-second rolling avg of 1hz data")
     plot.set_xlabel("date/time")
@@ -1,18 +1,33 @@
 #!/usr/bin/env python3
 
 # read PMS3001 data from the serial port. timestamp each line when it
-# arrives. batch into 30-record chunks and insert all records into the
-# database. also write json-formatted records to stdout.
+# arrives. batch into chunks of up to 600 records (or whatever arrived
+# in the last minute) and insert all records into the database. also
+# write json-formatted records to stdout.
 
-import aqi
 import argparse
+import bisect
 import datetime
-import json
+import io
+import itertools
+import math
+import orjson
+import os
 import psycopg2
-import psycopg2.extras
+import select
 import sys
+import time
 
-MAX_CACHE_SIZE = 30
+MAX_CACHE_SIZE = 600
+MAX_FLUSH_INTERVAL_SEC = 60
+READ_SIZE = 4096
+
+# EPA PM2.5 -> AQI breakpoints; each row of the table maps the
+# concentration range [BP_LO, BP_HI] linearly onto [I_LO, I_HI]
+BP_LO = (0.0, 12.1, 35.5, 55.5, 150.5, 250.5, 350.5)
+BP_HI = (12.0, 35.4, 55.4, 150.4, 250.4, 350.4, 500.4)
+I_LO = (0, 51, 101, 151, 201, 301, 401)
+I_HI = (50, 100, 150, 200, 300, 400, 500)
 
 logfile = sys.stdout
 
@@ -21,59 +36,111 @@ def say(s):
         logfile.write(s)
         logfile.write("\n")
 
-def insert_batch(db, data):
-    sys.stderr.write(f"inserting {len(data)} records\n")
-    insert_query = 'insert into particulate (time, pm10, pm25, pm100, aqi) values %s'
+# Equivalent of aqi.to_iaqi(POLLUTANT_PM25, pm, ALGO_EPA) without the
+# Decimal arithmetic. Concentrations above the last breakpoint are
+# extrapolated linearly.
+def pm25_to_aqi(pm):
+    pm = math.floor(pm * 10) / 10
+    i = min(bisect.bisect_left(BP_HI, pm), len(BP_HI) - 1)
+    return round(I_LO[i] + (I_HI[i] - I_LO[i]) * (pm - BP_LO[i]) / (BP_HI[i] - BP_LO[i]))
+
+# escapes for special characters in COPY text format values
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+# format one value as a field of a COPY text format row
+def _fmt(val):
+    if val is None:
+        return '\\N'
+    if isinstance(val, datetime.datetime):
+        return val.isoformat()
+    if isinstance(val, str):
+        return val.translate(COPY_ESCAPES)
+    return str(val)
+
+# insert the first n records of data
+def insert_batch(db, data, n):
+    sys.stderr.write(f"inserting {n} records\n")
+    buf = io.StringIO()
+    for r in itertools.islice(data, n):
+        buf.write('\t'.join(map(_fmt, r)) + '\n')
+    buf.seek(0)
     cursor = db.cursor()
-    psycopg2.extras.execute_values(
-        cursor,
-        insert_query,
-        data,
-        template=None,
+    cursor.copy_from(
+        buf,
+        'particulate',
+        columns=('time', 'pm10', 'pm25', 'pm100', 'aqi'),
     )
     db.commit()
 
 
-def line_arrived(cache, db, t, line):
-    data = json.loads(line)
-
-    printable_data = data.copy()
-    printable_data['time'] = t.timestamp()
-    printable_data['ftime'] = t.strftime("%Y-%m-%d %H:%M:%S.%f")
-    say(json.dumps(printable_data))
-    sys.stdout.flush()
-
-    data['time'] = t
-    data['aqi'] = int(aqi.to_iaqi(
-        aqi.POLLUTANT_PM25,
-        data['pm2.5'],
-        algo=aqi.ALGO_EPA))
+def line_arrived(t_ns, line):
+    line = line.strip()
+    data = orjson.loads(line)
+    t = datetime.datetime.fromtimestamp(t_ns / 1e9)
+    aqi = pm25_to_aqi(data['pm2.5'])
 
+    # echo the record by splicing the timestamps into the json text we
+    # received, rather than copying and re-serializing the parsed dict.
+    # The line is known to be a valid, non-empty object at this point,
+    # so it ends in '}' and the fields can go just before it.
+    ftime = t.isoformat(sep=' ', timespec='microseconds')
+    say(f'{line[:-1].decode()},"time":{t_ns / 1e9},"ftime":"{ftime}"}}')
 
     db_record = [
-        data['time'],
-        data['pm1.0'],
+        t,
+        data.get('pm1.0'),
         data['pm2.5'],
-        data['pm10.0'],
-        data['aqi'],
+        data.get('pm10.0'),
+        aqi,
     ]
 
-    cache.append(db_record)
+    return db_record
 
-    if len(cache) >= MAX_CACHE_SIZE:
-        insert_batch(db, cache)
-        cache.clear()
-                 
 def read_forever(db, f):
-    cache = []
+    # fixed-size cache, filled by index and reused after each flush
+    cache = [None] * MAX_CACHE_SIZE
+    n = 0
+    last_flush = time.monotonic()
+    fd = f.fileno()
+    # bytes read from the port that don't yet make up a complete line
+    pending = bytearray()
     while True:
-        line = f.readline()
-        if not line:
-            say("Got EOF! Terminating")
-            return
-        line = line.rstrip()
-        if line:
-            line_arrived(cache, db, datetime.datetime.now(), line)
+        # wait for input, but wake up in time to flush the cache even
+        # if the sensor has gone quiet
+        timeout = max(0, last_flush + MAX_FLUSH_INTERVAL_SEC - time.monotonic())
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if ready:
+            # read whatever is available in one syscall and split out
+            # the complete lines, keeping any partial line for next time
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                if n:
+                    insert_batch(db, cache, n)
+                say("Got EOF! Terminating")
+                return
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                cache[n] = line_arrived(time.time_ns(), line)
+                n += 1
+                if n >= MAX_CACHE_SIZE:
+                    insert_batch(db, cache, n)
+                    n = 0
+                    last_flush = time.monotonic()
+
+        if time.monotonic() - last_flush >= MAX_FLUSH_INTERVAL_SEC:
+            if n:
+                insert_batch(db, cache, n)
+                n = 0
+            last_flush = time.monotonic()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -89,11 +156,14 @@ def main():
         action='store'
     )
     args = parser.parse_args()
+    sys.stdout.reconfigure(line_buffering=True)
     say(f"Starting; args: {args}")
     if args.log:
         global logfile
-        logfile = open(args.log, "a")
-    infile = open(args.port, "r")
+        logfile = open(args.log, "a", buffering=1)
+    # unbuffered; read_forever does its own buffering on the raw fd, so
+    # that select() never misses lines sitting in a python-side buffer
+    infile = open(args.port, "rb", buffering=0)
     say("Opened file")
     db = psycopg2.connect(database="airquality")
     read_forever(db, infile)
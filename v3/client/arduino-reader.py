@@ -22,10 +22,10 @@
 
 import argparse
 import datacache
-import datetime
-import json
+import orjson
 import os
 import sys
+import time
 
 # project libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
@@ -45,8 +45,8 @@ def read_forever(infile, cache):
             continue
 
         # get data sent by arduino and timestamp it
-        data = json.loads(line)
-        data['time'] = datetime.datetime.now()
+        data = orjson.loads(line)
+        data['time'] = time.time()
 
         # append to cache
         cache.append(data)
@@ -73,7 +73,7 @@ def main():
     say(f"Starting; args: {args}")
 
     # open input file
-    infile = open(args.device, "r")
+    infile = open(args.device, "rb")
     say(f"Opened input file {args.device}")
 
     # create a cache
@@ -1,29 +1,130 @@
 # Caching class that accepts records without blocking, and periodically flushes
 # the cache to the downstream data sink.
 
+import collections
+import itertools
+import orjson
 import os
+import struct
 import sys
 import threading
-import time
 
 # project libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from common.mylogging import say
 import httpclient
 
+# Most records sent in a single POST. A backlog built up during an outage
+# is sent in slices of this size, so that no request grows past what the
+# server will accept (about 1 MB of json per slice for a typical sensor).
+MAX_RECORDS_PER_POST = 3600
+
 class DataCache(threading.Thread):
     def __init__(self, args):
         threading.Thread.__init__(self)
         self.args = args
         self.daemon = True
-        self.cache = []
+        # deque append and popleft are atomic, so the producer and the
+        # flushing thread can share the cache without a lock. It is bounded
+        # so that it can't grow without limit while the flusher is stuck in
+        # a slow POST; the oldest records are dropped first.
+        self.cache = collections.deque(maxlen=args.max_cache)
+        self.flush_event = threading.Event()
+        # map from a record's keys and value types to its packed layout
+        self.layouts = {}
         self.client = httpclient.DataClient(args)
-        self.lock = threading.Lock()
+        self.spool_path = args.spool_path
+        self.spool_fd = None
+        self.spool_lock = threading.Lock()
+        if args.spool_path:
+            self._open_spool(args.spool_path)
         self.start()
 
+    # The spool is an append-only file holding one json record per line for
+    # every record that has been accepted but not yet sent to the server, so
+    # that they survive a restart. Records left over from a previous run are
+    # queued for sending.
+    def _open_spool(self, path):
+        if os.path.exists(path):
+            count = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # a partial line from an interrupted write
+                        continue
+                    self.cache.append(self._pack(record))
+                    count += 1
+            say(f"recovered {count} unsent records from {path}")
+        # start from a clean file, without any partial trailing line
+        self._rewrite_spool()
+
+    # Replace the spool's contents with the records in pending (those
+    # taken from the cache but not yet sent) followed by the ones still
+    # waiting in the cache. Called at startup and after successful sends. The new
+    # contents are written and synced to a temporary file that is then
+    # renamed over the spool, so a crash at any point leaves either the
+    # old or the new spool intact, never an empty one.
+    def _rewrite_spool(self, pending=()):
+        tmp_path = self.spool_path + ".tmp"
+        with self.spool_lock:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, b"".join(
+                    orjson.dumps(self._unpack(r)) + b"\n"
+                    for r in itertools.chain(pending, list(self.cache))))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, self.spool_path)
+            new_fd = os.open(self.spool_path, os.O_WRONLY | os.O_APPEND)
+            if self.spool_fd is not None:
+                os.close(self.spool_fd)
+            self.spool_fd = new_fd
+
+    # Records are held packed, as a (layout, bytes) pair, which is far
+    # smaller than a dict when many records are queued up during a network
+    # outage. Ints are stored as 64-bit ints and floats as doubles, so each
+    # record unpacks to exactly the values it was given. Records that can't
+    # be packed (e.g., non-numeric or out-of-range values) are held as-is.
+    def _pack(self, record):
+        codes = []
+        for val in record.values():
+            t = type(val)
+            if t is float:
+                codes.append('d')
+            elif t is int:
+                codes.append('q')
+            else:
+                return record
+        keys = tuple(record)
+        fmt = "".join(codes)
+        layout = self.layouts.get((keys, fmt))
+        if layout is None:
+            layout = (keys, struct.Struct(f"<{fmt}"))
+            self.layouts[(keys, fmt)] = layout
+        try:
+            return (layout, layout[1].pack(*record.values()))
+        except (struct.error, OverflowError):
+            return record
+
+    def _unpack(self, packed):
+        if isinstance(packed, dict):
+            return packed
+        (keys, layout), data = packed
+        return dict(zip(keys, layout.unpack(data)))
+
     def append(self, record):
-        with self.lock:
-            self.cache.append(record)
+        packed = self._pack(record)
+        if self.spool_fd is None:
+            self.cache.append(packed)
+        else:
+            with self.spool_lock:
+                os.write(self.spool_fd, orjson.dumps(record) + b"\n")
+                self.cache.append(packed)
+        if len(self.cache) >= self.args.flush_records:
+            self.flush_event.set()
         if self.args.verbose:
             say(f"got record: {record}")
 
@@ -33,21 +134,41 @@ class DataCache(threading.Thread):
     def run(self):
         to_xmit = []
         while True:
+            # Clear the flush request before draining, so that one made while
+            # we drain or send wakes the wait below instead of being lost
+            self.flush_event.clear()
+
             # Move any records in the cache into a local variable to transmit to
             # the server
-            with self.lock:
-                to_xmit.extend(self.cache)
-                self.cache.clear()
+            while self.cache:
+                to_xmit.append(self.cache.popleft())
 
-            # If there is anything to transmit, try to send them to the server
-            if len(to_xmit) > 0:
-                # Try to send the locally stored records to the server
-                retval = self.client.insert_batch(to_xmit)
+            # If the server has been unreachable for a long time, discard the
+            # oldest records rather than growing without bound
+            if len(to_xmit) > self.args.max_cache:
+                dropped = len(to_xmit) - self.args.max_cache
+                say(f"cache full; dropping {dropped} oldest records")
+                del to_xmit[:dropped]
+
+            # If there is anything to transmit, try to send them to the server,
+            # oldest first, in slices of bounded size
+            sent = 0
+            while to_xmit:
+                batch = to_xmit[:MAX_RECORDS_PER_POST]
+                retval = self.client.insert_batch([self._unpack(r) for r in batch])
 
                 # If the send was successful, discard these records. Otherwise, save
-                # them so we can try to send them again next time around.
-                if retval:
-                    to_xmit.clear()
+                # them (and the rest) so we can try to send them again next time
+                # around.
+                if not retval:
+                    break
+                del to_xmit[:len(batch)]
+                sent += len(batch)
+
+            # Remove whatever was sent from the spool
+            if sent and self.spool_fd is not None:
+                self._rewrite_spool(to_xmit)
 
-            # Wait until it's time to transmit again
-            time.sleep(15)
+            # Wait until it's time to transmit again, or until enough records
+            # have arrived to be worth sending early
+            self.flush_event.wait(timeout=self.args.flush_sec)
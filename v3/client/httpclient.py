@@ -1,17 +1,21 @@
 # HTTP client that takes sensor data and POSTs it to a waiting listener
 
 import binascii
-import datetime
+import gzip
 import hashlib
+import hmac
+import orjson
 import os
-import random
 import requests
-import string
+import secrets
+import socket
 import sys
+import urllib3
 
 # project libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from common.mylogging import say
+import common.util
 
 # Build an argparse parser for standard arguments for clients: sensor id, url and password
 def build_parser(parser):
@@ -39,13 +43,68 @@ def build_parser(parser):
         action='store_true',
         default=False,
     )
+    parser.add_argument(
+        '--max-cache',
+        help="Maximum number of records to hold while the server is unreachable",
+        type=common.util.gtzero,
+        action='store',
+        default=86400,
+    )
+    parser.add_argument(
+        '--flush-sec',
+        help="Seconds between posts to the server",
+        type=common.util.gtzero,
+        action='store',
+        default=30,
+    )
+    parser.add_argument(
+        '--flush-records',
+        help="Post early once this many records are waiting",
+        type=common.util.gtzero,
+        action='store',
+        default=256,
+    )
+    parser.add_argument(
+        '--spool-path',
+        help="File in which to keep unsent records across restarts",
+        action='store',
+        default=None,
+    )
+
+# Transport adapter that turns off Nagle's algorithm and turns on TCP
+# keepalives, so the long-lived connection to the server neither delays
+# small POSTs nor silently goes stale between batches
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
 
 class DataClient:
     def __init__(self, args):
         self.sensorname = args.sensor_name
         self.url = args.url
         self.password = args.password.encode('utf-8')
+        # keyed once; each batch copies it rather than rehashing the key
+        self.hmac_template = hmac.new(self.password, digestmod=hashlib.sha256)
+        # one session for the life of the client, so the TCP/TLS
+        # connection to the server is kept alive between batches
         self.session = requests.Session()
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+        })
+        adapter = KeepAliveAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=urllib3.util.Retry(total=3, backoff_factor=0.3),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.cb = None
 
     def set_send_callback(self, cb):
@@ -56,25 +115,21 @@ class DataClient:
             self.sensorname, len(recordlist),
             recordlist[0]['time'], recordlist[-1]['time']))
 
-        for rec in recordlist:
-            if isinstance(rec['time'], datetime.datetime):
-                rec['time'] = rec['time'].timestamp()
-
         payload = {
             'sensorname': self.sensorname,
             'sensordata': recordlist,
         }
 
         # add authenticator
-        payload['salt'] = ''.join(random.choices(string.ascii_uppercase, k=20))
-        auth = hashlib.sha256(payload['salt'].encode('utf-8'))
-        auth.update(self.password)
-        payload['auth'] = auth.digest().hex()
+        payload['salt'] = secrets.token_hex(10)
+        auth = self.hmac_template.copy()
+        auth.update(payload['salt'].encode('utf-8'))
+        payload['hmac'] = auth.hexdigest()
 
         try:
             retval = self.session.post(
                 self.url,
-                json=payload,
+                data=gzip.compress(orjson.dumps(payload)),
                 timeout=30,
             )
         except Exception as e:
@@ -52,8 +52,6 @@ SENSOR_PATH = "/dev/ttyS0"
 
 # system imports
 import argparse
-import collections
-import datetime
 import os
 import serial
 import struct
@@ -66,13 +64,20 @@ import httpclient
 import datacache
 from common.mylogging import say
 
+# PMS5003 frame layout: header, frame length, 12 data words, (reserved
+# word), checksum
+FRAME = struct.Struct(">HH12H2xH")
+
 class PM25:
     """Super-class for generic PM2.5 sensors. Subclasses must implement
     _read_into_buffer to fill self._buffer with a packet of data"""
 
     def __init__(self):
-        # rad, ok make our internal buffer!
-        self._buffer = bytearray(32)
+        # rad, ok make our internal buffer! it is allocated once and
+        # refilled in place for every frame
+        self._buffer = bytearray(FRAME.size)
+        # zero-copy view for slicing; the buffer is never resized
+        self._mv = memoryview(self._buffer)
         self.field_names = (
             "pm10_standard",
             "pm25_standard",
@@ -87,7 +92,6 @@ class PM25:
             "particles_50um",
             "particles_100um",
         )
-        self.aqType = collections.namedtuple('aqdata', self.field_names)
 
     def getFields(self):
         return self.field_names
@@ -100,34 +104,34 @@ class PM25:
         """Read any available data from the air quality sensor and
         return a dictionary with available particulate/quality data"""
         self._read_into_buffer()
-        # print([hex(i) for i in self._buffer])
+        # print(self._buffer.hex())
+
+        header, frame_len, *fields, checksum = FRAME.unpack_from(self._buffer)
 
         # check packet header
-        if (self._buffer[0] != 0x42) or (self._buffer[1] != 0x4D):
+        if header != 0x424D:
             raise RuntimeError("Invalid PM2.5 header")
 
         # check frame length
-        frame_len = struct.unpack(">H", self._buffer[2:4])[0]
         if frame_len != 28:
             raise RuntimeError("Invalid PM2.5 frame length")
 
-        checksum = struct.unpack(">H", self._buffer[30:32])[0]
-        check = sum(self._buffer[0:30])
+        check = sum(self._mv[0:30])
         if check != checksum:
             raise RuntimeError("Invalid PM2.5 checksum")
 
         # unpack data
-        return self.aqType._asdict(
-            self.aqType._make(
-                struct.unpack(">HHHHHHHHHHHH", self._buffer[4:28])
-            )
-        )
+        return dict(zip(self.field_names, fields))
 
 class PM25_UART(PM25):
     """
-    A driver for the PM2.5 Air quality sensor over UART
+    A driver for the PM2.5 Air quality sensor over UART. The uart should
+    have a short read timeout (about one frame time); reads are retried
+    until a whole frame arrives or FRAME_TIMEOUT_SEC passes.
     """
 
+    FRAME_TIMEOUT_SEC = 2
+
     def __init__(self, uart, reset_pin=None):
         if reset_pin:
             # Reset device
@@ -139,22 +143,33 @@ class PM25_UART(PM25):
             time.sleep(1)
 
         self._uart = uart
+        self._readahead = bytearray()
         super().__init__()
 
     def _read_into_buffer(self):
+        # Read from the UART in blocks rather than a byte at a time, and
+        # look for the start-of-frame marker in what has accumulated
+        deadline = time.monotonic() + self.FRAME_TIMEOUT_SEC
         while True:
-            b = self._uart.read(1)
-            if not b:
-                raise RuntimeError("Unable to read from PM2.5 (no start of frame)")
-            if b[0] == 0x42:
+            start = self._readahead.find(b'\x42\x4d')
+            if start < 0:
+                # no frame start; keep only a trailing byte that might be
+                # the first half of one
+                del self._readahead[:-1]
+            elif len(self._readahead) >= start + 32:
                 break
-        self._buffer[0] = b[0]  # first byte and start of frame
 
-        remain = self._uart.read(31)
-        if not remain or len(remain) != 31:
-            raise RuntimeError("Unable to read from PM2.5 (incomplete frame)")
-        for i in range(31):
-            self._buffer[i + 1] = remain[i]
+            if time.monotonic() > deadline:
+                if start < 0:
+                    raise RuntimeError("Unable to read from PM2.5 (no start of frame)")
+                raise RuntimeError("Unable to read from PM2.5 (incomplete frame)")
+            self._readahead += self._uart.read(max(32, self._uart.in_waiting))
+
+        # copy the frame through a temporary view rather than a slice
+        # copy; the view must be released before the read-ahead is resized
+        with memoryview(self._readahead) as mv:
+            self._buffer[:] = mv[start:start + 32]
+        del self._readahead[:start + 32]
 
 def main():
     parser = argparse.ArgumentParser()
@@ -167,12 +182,12 @@ def main():
 
     # start reading!
     say(f"Opening {SENSOR_PATH}")
-    uart = serial.Serial(SENSOR_PATH, baudrate=9600, timeout=2)
+    uart = serial.Serial(SENSOR_PATH, baudrate=9600, timeout=0.05)
     pm25 = PM25_UART(uart)
     while True:
         data = pm25.read()
         cache.append({
-            'time': datetime.datetime.now(),
+            'time': time.time(),
             'pm1.0': data['pm10_standard'],
             'pm2.5': data['pm25_standard'],
             'pm10.0': data['pm100_standard'],
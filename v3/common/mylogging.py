@@ -1,13 +1,67 @@
 #!/usr/bin/env python3
 
+import atexit
+import queue
 import sys
+import threading
 
+# say() only enqueues; a background thread does all the writes, and
+# flushes whenever it catches up, so callers never wait on log I/O
 logfile = sys.stdout
+_queue = queue.SimpleQueue()
+
+# Longest flush() will wait for the writer to catch up
+FLUSH_TIMEOUT_SEC = 5
 
 def say(s):
-    logfile.write(f"{s}\n")
-    logfile.flush()
+    _queue.put(f"{s}\n")
 
 def open_logfile(filename):
     global logfile
+    flush()
     logfile = open(filename, "a")
+
+# Block until everything said so far has been written and flushed
+def flush():
+    if not _writer.is_alive():
+        return
+    done = threading.Event()
+    _queue.put(done)
+    done.wait(FLUSH_TIMEOUT_SEC)
+
+# Report a failed log write on stderr, once until writes start working
+# again, rather than letting it kill the writer thread
+_write_failing = False
+
+def _write_error(e):
+    global _write_failing
+    if _write_failing:
+        return
+    _write_failing = True
+    try:
+        sys.stderr.write(f"mylogging: error writing log: {e!r}\n")
+        sys.stderr.flush()
+    except Exception:
+        pass
+
+def _write_forever():
+    global _write_failing
+    while True:
+        item = _queue.get()
+        try:
+            if isinstance(item, threading.Event):
+                logfile.flush()
+            else:
+                logfile.write(item)
+                if _queue.empty():
+                    logfile.flush()
+            _write_failing = False
+        except Exception as e:
+            _write_error(e)
+        finally:
+            if isinstance(item, threading.Event):
+                item.set()
+
+_writer = threading.Thread(target=_write_forever, daemon=True)
+_writer.start()
+atexit.register(flush)
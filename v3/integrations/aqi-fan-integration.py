@@ -54,18 +54,39 @@ class AQIChangeHandler:
             signal_name='NewDataAvailable',
         )
         self.pmsdb = pms5003db.PMS5003Database()
+        self.prepared_db = None
+
+        # resolve sensor and datatype names to database ids once, rather
+        # than on every signal, and index the config by sensor name
+        self.configs_by_sensor = {}
+        for c in CONFIG:
+            c['sensorid'] = self.pmsdb.get_sensorid_by_name(c['sensorname'])
+            c['datatypeid'] = self.pmsdb.get_datatype_by_name(c['datatype'])
+            self.configs_by_sensor.setdefault(c['sensorname'], []).append(c)
 
     # dbus signal handler
     def NewDataAvailable(self, *args, **kwargs):
         argdict = dict(args[0])
         sensorname = str(argdict['sensorname'])
 
-        for c in CONFIG:
-            if c['sensorname'] == sensorname:
-                self.maybe_on_off(c)
+        for c in self.configs_by_sensor.get(sensorname, []):
+            self.maybe_on_off(c)
 
     def maybe_on_off(self, c):
-        aqi = round(self.get_oneminute_average(c), 2)
+        # A sensor or datatype that isn't in the database can never have
+        # data, so don't bother asking
+        if c['sensorid'] is None or c['datatypeid'] is None:
+            say(f"sensor {c['sensorname']}: no {c['datatype']} data in database; ignoring")
+            return
+
+        # No records in the averaging window (e.g., this batch had no
+        # readings of this datatype): leave the fan alone
+        aqi = self.get_oneminute_average(c)
+        if aqi is None:
+            say(f"sensor {c['sensorname']}: no recent {c['datatype']} data")
+            return
+
+        aqi = round(aqi, 2)
         say(f"sensor {c['sensorname']} aqi now {aqi}")
 
         fan_is_on = c.get('fan-is-on', False)
@@ -81,20 +102,29 @@ class AQIChangeHandler:
         # Note, cursor() executes rollback to end a prior transaction.
         # Otherwise, the value of now() never changes
         db = self.pmsdb.get_raw_db()
-        cursor = db.cursor()
-        cursor.execute(
-            """
-            select
-               avg("value") from sensordatav4_tsdb
-            where
-               sensorid=%s and
-               datatype=%s and
-                time > now() - interval '%s seconds'""", (
-                    self.pmsdb.get_sensorid_by_name(c['sensorname']),
-                    self.pmsdb.get_datatype_by_name(c['datatype']),
+        with db.cursor() as cursor:
+            # Prepare the query once per connection so the server doesn't
+            # re-parse and re-plan it for every signal. get_raw_db may have
+            # reopened the connection, in which case prepare it again.
+            if db is not self.prepared_db:
+                cursor.execute(
+                    """
+                    prepare oneminute_average(integer, integer, integer) as
+                    select
+                       avg("value") from sensordatav4_tsdb
+                    where
+                       sensorid=$1 and
+                       datatype=$2 and
+                       time > now() - make_interval(secs => $3)""")
+                self.prepared_db = db
+
+            cursor.execute(
+                "execute oneminute_average(%s, %s, %s)", (
+                    c['sensorid'],
+                    c['datatypeid'],
                     c['averaging-sec'])
-        )
-        row = cursor.fetchone()
+            )
+            row = cursor.fetchone()
         db.rollback()
         return(row[0])
 
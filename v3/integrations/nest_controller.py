@@ -4,9 +4,13 @@ import json
 import os
 import pathlib
 import requests
+import time
 import yaml
 
 class NestController():
+    # Refresh the access token this long before it actually expires
+    TOKEN_EXPIRY_MARGIN_SEC = 60
+
     def __init__(self, device_name):
         config_fn = os.path.join(
             pathlib.Path.home(),
@@ -16,9 +20,16 @@ class NestController():
         if not device_name in config['devices']:
             raise(f"No such device '{device_name}' in config file '{config_fn}'")
         self.config.update(config['devices'][device_name])
+        self.access_token = None
+        self.token_expires = 0
+
+    # Get an access token using the refresh token. Access tokens are good
+    # for an hour, so reuse one until it is about to expire rather than
+    # doing an extra OAuth round trip for every request.
+    def _get_access_token(self):
+        if self.access_token and time.monotonic() < self.token_expires:
+            return self.access_token
 
-    def _execute_request(self, url, json_body=None):
-        # First, get a token using the refresh token
         params = {
             'client_id': self.config['client_id'],
             'client_secret': self.config['client_secret'],
@@ -30,15 +41,28 @@ class NestController():
             raise Exception(f"Failed to refresh token: {resp}")
         token_info = resp.json()
 
-        # Now, execute the request
-        headers = {
-            'Authorization': 'Bearer ' + token_info['access_token'],
-        }
+        self.access_token = token_info['access_token']
+        self.token_expires = time.monotonic() + \
+            token_info.get('expires_in', 0) - self.TOKEN_EXPIRY_MARGIN_SEC
+        return self.access_token
+
+    def _execute_request(self, url, json_body=None):
         print(f"Sending request to {url}: {json_body}")
-        if json_body:
-            resp = requests.post(url, headers=headers, json=json_body)
-        else:
-            resp = requests.get(url, headers=headers)
+        for attempt in range(2):
+            headers = {
+                'Authorization': 'Bearer ' + self._get_access_token(),
+            }
+            if json_body:
+                resp = requests.post(url, headers=headers, json=json_body)
+            else:
+                resp = requests.get(url, headers=headers)
+
+            # If the cached token was revoked before it expired, drop it
+            # and try once more with a fresh one
+            if resp.status_code != 401:
+                break
+            print("Access token rejected; refreshing")
+            self.access_token = None
 
         json_response = resp.json()
         print(f"Got response, status {resp.status_code}: {json.dumps(json_response, indent=True)}")
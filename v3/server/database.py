@@ -25,9 +25,7 @@ class DatabaseBatcher:
 
     # Data is a list of dicts mapping column name to value
     def insert_batch(self, recordlist):
-        values = []
-        for rec in recordlist:
-            values.append([rec[col] if col in rec else None for col in self.column_list])
+        values = ([rec.get(col) for col in self.column_list] for rec in recordlist)
 
         cursor = self.db.cursor()
 
@@ -37,6 +35,7 @@ class DatabaseBatcher:
                 self.stmt,
                 values,
                 template=None,
+                page_size=500,
             )
             #say(f"{len(recordlist)} records committed")
         except Exception as e:
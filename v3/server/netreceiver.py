@@ -5,23 +5,49 @@ import binascii
 import cherrypy
 import datetime
 import hashlib
-import json
+import hmac
+import orjson
 import os
 import subprocess
 import sys
 import tempfile
 import yaml
+import zlib
 
 # project libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import common.mylogging
 from common.mylogging import say
 import pms5003db
 
+DEFAULT_DB_POOL_SIZE = 8
+
+# Largest upload accepted, both as sent and after gzip decompression.
+# A full client cache (a day of 1-second records) is well under this.
+MAX_BODY_BYTES = 32 * 1024 * 1024
+
+# Client-supplied strings as bytes, or None if the field isn't a string
+# at all, so auth checks fail cleanly on malformed requests
+def _as_bytes(s):
+    if not isinstance(s, str):
+        return None
+    return s.encode('utf-8', 'surrogatepass')
+
+def _unhex(s):
+    if not isinstance(s, str):
+        return None
+    try:
+        return binascii.unhexlify(s)
+    except ValueError:
+        return None
+
 class SensorDataHandler():
     def __init__(self, config):
         self.config = config
-        self.db = pms5003db.PMS5003Database()
+        self.db = pms5003db.PMS5003Database(
+            pool_size=config['db-pool-size'])
         self.bin_password = config['password'].encode('utf-8')
+        self.hmac_template = hmac.new(self.bin_password, digestmod=hashlib.sha256)
         self.lookup_log = tempfile.NamedTemporaryFile(mode="w")
 
     @cherrypy.expose
@@ -30,13 +56,13 @@ class SensorDataHandler():
 
     @cherrypy.expose
     def mac_lookup(self, macaddr):
-        db = self.db.get_raw_db()
-        cursor = db.cursor()
-        cursor.execute(
-            "select name from sensordatav4_sensors where macaddr=%s",
-            (macaddr,))
-        result = cursor.fetchone()
-        db.rollback()
+        with self.db.connection() as db:
+            with db.cursor() as cursor:
+                cursor.execute(
+                    "select name from sensordatav4_sensors where macaddr=%s",
+                    (macaddr,))
+                result = cursor.fetchone()
+            db.rollback()
         if result:
             sensorname = result[0]
         else:
@@ -57,28 +83,64 @@ class SensorDataHandler():
             cherrypy.request.headers.get('User-Agent', 'no-user-agent')
         )
 
-        body = cherrypy.request.body.read()
+        body = cherrypy.request.body.read(MAX_BODY_BYTES + 1)
+        if len(body) > MAX_BODY_BYTES:
+            say(f"{debugstr}: request body too large")
+            cherrypy.response.status = 413
+            return
+
         try:
-            msg = json.loads(body)
+            # decompress with a cap on the output size, so a small
+            # compressed body can't expand without bound
+            if cherrypy.request.headers.get('Content-Encoding') == 'gzip':
+                d = zlib.decompressobj(wbits=31)
+                body = d.decompress(body, MAX_BODY_BYTES)
+                if d.unconsumed_tail:
+                    say(f"{debugstr}: decompressed body too large")
+                    cherrypy.response.status = 413
+                    return
+                if not d.eof:
+                    raise ValueError("truncated gzip stream")
+            msg = orjson.loads(body)
         except Exception as e:
-            say(f"{debugstr}: got invalid json document: {body}")
+            say(f"{debugstr}: got invalid json document ({len(body)} bytes): {e}: {body[:100]!r}")
             cherrypy.response.status = 400
             return
 
-        # check password -- secure method:
-        if 'salt' in msg and 'auth' in msg:
-            expected = hashlib.sha256(msg['salt'].encode('utf-8'))
-            expected.update(self.bin_password)
+        if not isinstance(msg, dict):
+            say(f"{debugstr}: got json document that is not an object")
+            cherrypy.response.status = 400
+            return
 
-            actual = binascii.unhexlify(msg['auth'])
-            if expected.digest() != actual:
+        # check password -- hmac method:
+        if 'salt' in msg and 'hmac' in msg:
+            salt = _as_bytes(msg['salt'])
+            actual = _as_bytes(msg['hmac'])
+            expected = self.hmac_template.copy()
+            expected.update(salt or b'')
+            if salt is None or actual is None or not hmac.compare_digest(
+                    expected.hexdigest().encode('ascii'), actual):
+                say("hmac mismatch")
+                cherrypy.response.status = 403
+                return
+
+        # check password -- older hash method:
+        elif 'salt' in msg and 'auth' in msg:
+            salt = _as_bytes(msg['salt'])
+            actual = _unhex(msg['auth'])
+            expected = hashlib.sha256(salt or b'')
+            expected.update(self.bin_password)
+            if salt is None or actual is None or not hmac.compare_digest(
+                    expected.digest(), actual):
                 say("auth mismatch")
                 cherrypy.response.status = 403
                 return
 
         # check password -- clowny method
         elif 'clowny-cleartext-password' in msg:
-            if msg['clowny-cleartext-password'] != self.config['password']:
+            actual = _as_bytes(msg['clowny-cleartext-password'])
+            if actual is None or not hmac.compare_digest(
+                    actual, self.bin_password):
                 say(f"password mismatch")
                 cherrypy.response.status = 403
                 return
@@ -126,12 +188,19 @@ def main():
     )
     args = parser.parse_args()
     if args.log:
-        logging.open_logfile(args.log)
+        common.mylogging.open_logfile(args.log)
     config = yaml.safe_load(open(args.config_file))
+    config.setdefault('db-pool-size', DEFAULT_DB_POOL_SIZE)
+
+    # Run one worker thread per pooled database connection. psycopg2's
+    # pool raises rather than blocks when it is exhausted, so extra
+    # threads would only turn into failed requests under load.
     cherrypy.config.update({
         'server.socket_host': '::',
         'server.socket_port': config['listen-port'],
         'server.socket_timeout': 30,
+        'server.max_request_body_size': MAX_BODY_BYTES,
+        'server.thread_pool': config['db-pool-size'],
     })
 
     if config.get('is-proxy', False):
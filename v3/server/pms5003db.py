@@ -6,9 +6,12 @@
 # from the raw PM2.5 value for each record.
 
 import aqi
+import contextlib
+import functools
 import os
 import sys
 import psycopg2
+import psycopg2.pool
 
 # project libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
@@ -16,7 +19,10 @@ from common.mylogging import say
 import server.database as database
 
 # Convert PM2.5 to AQI. It seems that AQI is not defined above PM2.5
-# of 500 so we just add to it linearly after that.
+# of 500 so we just add to it linearly after that. aqi.to_iaqi does
+# Decimal arithmetic and is slow, but sensors report a small set of
+# distinct (usually integer) values, so results are memoized.
+@functools.lru_cache(maxsize=4096)
 def convert_aqi(pm):
     if pm > 500:
         aqi_input = 500
@@ -35,22 +41,33 @@ def convert_aqi(pm):
 
 class PMS5003Database:
     DBNAME = "airquality"
+    POOL_MINCONN = 2
 
-    def __init__(self):
+    # If pool_size is given, connections handed out by connection()
+    # come from a thread-safe pool of up to that many connections, so
+    # that concurrent web server threads don't serialize on one handle.
+    # Without it, everything shares the single get_raw_db() connection.
+    def __init__(self, pool_size=None):
         self._db = None
-
-        db = self.get_raw_db()
-        cursor = db.cursor()
-        # get the list of valid sensor ids
-        cursor.execute("select name, id from sensordatav4_sensors")
-        self.sensornames = {row[0]: row[1] for row in cursor.fetchall()}
+        self._pool = None
+        if pool_size:
+            say(f"Opening pool of up to {pool_size} connections to database {self.DBNAME}")
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                min(self.POOL_MINCONN, pool_size), pool_size,
+                database=self.DBNAME)
+
+        with self.connection() as db:
+            with db.cursor() as cursor:
+                # get the list of valid sensor ids
+                cursor.execute("select name, id from sensordatav4_sensors")
+                self.sensornames = {row[0]: row[1] for row in cursor.fetchall()}
+
+                # get the list of valid data types
+                cursor.execute("select name, id from sensordatav4_types")
+                self.datatypes = {row[0]: row[1] for row in cursor.fetchall()}
+            db.rollback()
         say(f"sensor names: {self.sensornames}")
-
-        # get the list of valid data types
-        cursor.execute("select name, id from sensordatav4_types")
-        self.datatypes = {row[0]: row[1] for row in cursor.fetchall()}
         say(f"data types: {self.datatypes}")
-        db.rollback()
 
     def get_raw_db(self):
         # Test the database to see if it works by executing a
@@ -69,6 +86,50 @@ class PMS5003Database:
         say("Could not get working database - exiting")
         sys.exit(1)
 
+    # Check a connection out of the pool, testing it with a rollback
+    # like get_raw_db does; a dead connection (closed, or broken by a
+    # server restart) is discarded and replaced. This runs in web server
+    # worker threads, so failure raises rather than exiting.
+    #
+    # The pool raises PoolError rather than blocking when all of its
+    # connections are checked out, so pool_size must be at least the
+    # number of threads that can call this at once. netreceiver sets
+    # CherryPy's server.thread_pool to the same value.
+    def get_conn(self):
+        for i in range(2):
+            conn = self._pool.getconn()
+            try:
+                conn.rollback()
+                return conn
+            except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
+                say(f"Exception using pooled db; discarding: {e}")
+                self._pool.putconn(conn, close=True)
+
+        raise Exception("could not get a working database connection")
+
+    # Return a connection to the pool, abandoning any transaction the
+    # caller left open. Connections that are already closed are dropped.
+    def put_conn(self, conn):
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        self._pool.putconn(conn, close=bool(conn.closed))
+
+    # Usage: "with pmsdb.connection() as db:". Yields a pooled
+    # connection if a pool was configured, or the shared one otherwise.
+    @contextlib.contextmanager
+    def connection(self):
+        if not self._pool:
+            yield self.get_raw_db()
+            return
+
+        conn = self.get_conn()
+        try:
+            yield conn
+        finally:
+            self.put_conn(conn)
+
     def get_sensorid_by_name(self, sensorname):
         return self.sensornames.get(sensorname, None)
 
@@ -94,6 +155,8 @@ class PMS5003Database:
 
         # generate a list of rows to be inserted into the database
         # from the json record sent by the client
+        datatypes = self.datatypes
+        unknown = set()
         insertion_list = []
         for record in recordlist:
             time = record.pop('time')
@@ -106,9 +169,9 @@ class PMS5003Database:
             # id associated with that datatype name and prepare a
             # database row with that data and the record's time
             for key, val in record.items():
-                datatype = self.get_datatype_by_name(key)
+                datatype = datatypes.get(key)
                 if not datatype:
-                    say(f"WARNING: sensor {sensorname} sent unknown field '{key}'")
+                    unknown.add(key)
                     continue
                 insertion_list.append({
                     'time': time,
@@ -117,37 +180,42 @@ class PMS5003Database:
                     'value': val,
                 })
 
-        db = self.get_raw_db()
-        cursor = db.cursor()
-        psycopg2.extras.execute_values(
-            cursor,
-            "insert into sensordatav4_tsdb (time, sensorid, datatype, value, received_at) values %s",
-            insertion_list,
-            template="(%(time)s, %(sensorid)s, %(datatype)s, %(value)s, now())",
-        )
-
-        # find the most recent record of each datatype and update the
-        # "latest records" list. Latest is a map from each datatype to
-        # the most recent record of that datatype.
-        latest = {}
-        for insertion in insertion_list:
-            datatype = insertion['datatype']
-            if not datatype in latest or latest[datatype]['time'] < insertion['time']:
-                latest[datatype] = insertion
-        psycopg2.extras.execute_values(
-            cursor,
-            """
-            insert into sensordatav4_latest (sensorid, datatype, time, value, received_at)
-            values %s
-            on
-               conflict (sensorid, datatype)
-            do
-                update set
-                    time=excluded.time,
-                    value=excluded.value,
-                    received_at=excluded.received_at
-            """,
-            list(latest.values()),
-            template="(%(sensorid)s, %(datatype)s, %(time)s, %(value)s, now())",
-        )
-        db.commit()
+        # warn once per batch rather than once per record
+        for key in sorted(unknown):
+            say(f"WARNING: sensor {sensorname} sent unknown field '{key}'")
+
+        with self.connection() as db:
+            cursor = db.cursor()
+            psycopg2.extras.execute_values(
+                cursor,
+                "insert into sensordatav4_tsdb (time, sensorid, datatype, value, received_at) values %s",
+                insertion_list,
+                template="(%(time)s, %(sensorid)s, %(datatype)s, %(value)s, now())",
+            )
+
+            # find the most recent record of each datatype and update the
+            # "latest records" list. Latest is a map from each datatype to
+            # the most recent record of that datatype.
+            latest = {}
+            for insertion in insertion_list:
+                datatype = insertion['datatype']
+                prev = latest.get(datatype)
+                if prev is None or prev['time'] < insertion['time']:
+                    latest[datatype] = insertion
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                insert into sensordatav4_latest (sensorid, datatype, time, value, received_at)
+                values %s
+                on
+                   conflict (sensorid, datatype)
+                do
+                    update set
+                        time=excluded.time,
+                        value=excluded.value,
+                        received_at=excluded.received_at
+                """,
+                list(latest.values()),
+                template="(%(sensorid)s, %(datatype)s, %(time)s, %(value)s, now())",
+            )
+            db.commit()
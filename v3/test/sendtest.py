@@ -4,9 +4,9 @@
 
 # python standard libraries
 import argparse
-import datetime
 import os
 import sys
+import time
 
 # project libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
@@ -15,7 +15,7 @@ import common.util
 
 
 def test(client, args):
-    t = datetime.datetime.now()
+    t = time.time()
     records = []
     for i in range(args.num_records):
         records.append({
@@ -24,7 +24,7 @@ def test(client, args):
             'pm2.5': 100+i,
             'pm10.0': 1000+i,
         })
-        t = t + datetime.timedelta(seconds=0.1)
+        t = t + 0.1
 
     retval = client.insert_batch(records)
     print(f"Retval: {retval}")